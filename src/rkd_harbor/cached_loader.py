@@ -14,6 +14,13 @@ class CachedLoader(object):
 
         return cls.items[name]
 
+    @classmethod
+    def invalidate(cls, *names: str):
+        """Forgets selected entries only, when their source has changed"""
+
+        for name in names:
+            cls.items.pop(name, None)
+
     @classmethod
     def clear(cls):
         cls.items = {}
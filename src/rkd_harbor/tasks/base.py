@@ -1,7 +1,7 @@
 
 import os
 import yaml
-import pkg_resources
+from functools import lru_cache
 from contextlib import contextmanager
 from subprocess import check_output
 from argparse import ArgumentParser
@@ -21,6 +21,26 @@ from ..interface import HarborTaskInterface
 SCRIPT_PATH = os.path.dirname(os.path.realpath(__file__))
 
 
+@lru_cache(maxsize=1)
+def get_installed_harbor_version() -> str:
+    """Looks up the installed version once per process - distribution metadata lookup is slow"""
+
+    try:
+        from importlib.metadata import version
+
+    # Python 3.6 and 3.7 do not have importlib.metadata
+    except ImportError:
+        import pkg_resources
+
+        def version(name: str) -> str:
+            return pkg_resources.get_distribution(name).version
+
+    try:
+        return version('harbor')
+    except Exception:
+        return 'dev'
+
+
 class UpdateStrategy(Enum):
     rolling = 'rolling'
     recreate = 'recreate'
@@ -198,10 +218,7 @@ class HarborBaseTask(HarborTaskInterface):
                 raise e
 
     def get_harbor_version(self) -> str:
-        try:
-            return pkg_resources.get_distribution("harbor").version
-        except:
-            return 'dev'
+        return get_installed_harbor_version()
 
     def _silent_mkdir(self, path: str):
         try:
@@ -1,5 +1,8 @@
 import os
+import re
+import importlib.util
 import subprocess
+import time
 from typing import Dict
 from typing import Tuple
 from argparse import ArgumentParser
@@ -33,6 +36,9 @@ Example usage:
 
     # use SSH-AGENT & key-based authentication by specifying path to private key
     harbor :deployment:apply --git-key=~/.ssh/id_rsa
+
+    # do not use Mitogen, even if it is installed (eg. installed version does not support your Ansible version)
+    harbor :deployment:apply --no-mitogen
     """
 
     def get_name(self) -> str:
@@ -62,6 +68,8 @@ Example usage:
         parser.add_argument('--branch', '-b', help='Git branch to deploy from', default='master')
         parser.add_argument('--profile', help='Harbor profile to filter out services that needs to be deployed',
                             default='')
+        parser.add_argument('--no-mitogen', action='store_true',
+                            help='Do not use Mitogen strategy, even if Mitogen is installed')
         self._add_ask_pass_arguments_to_argparse(parser)
         self._add_vault_arguments_to_argparse(parser)
 
@@ -72,6 +80,7 @@ Example usage:
         branch = context.get_arg('--branch')
         profile = context.get_arg('--profile')
         debug = context.get_arg('--debug')
+        no_mitogen = context.get_arg('--no-mitogen')
 
         # keep the vault arguments for decryption of deployment.yml
         self._preserve_vault_parameters_for_usage_in_inner_tasks(context)
@@ -96,8 +105,7 @@ Example usage:
 
             if git_private_key_path:
                 sock, pid = self.spawn_ssh_agent()
-                command += 'export SSH_AUTH_SOCK=%s; export SSH_AGENT_PID=%i; ssh-add %s; sleep 5; ' % \
-                           (sock, pid, git_private_key_path)
+                command += 'export SSH_AUTH_SOCK=%s; export SSH_AGENT_PID=%i; ' % (sock, pid)
 
             if debug:
                 opts += ' -vv '
@@ -107,6 +115,21 @@ Example usage:
             opts += self._get_vault_opts(context, '../../')
 
             os.chdir(self.ansible_dir)
+
+            if git_private_key_path:
+                self.add_ssh_key(sock, pid, git_private_key_path)
+
+            # configuration file selected by the user has priority over the one shipped with Harbor
+            if not os.getenv('ANSIBLE_CONFIG'):
+                command += 'export ANSIBLE_CONFIG=./ansible.cfg; '
+
+            mitogen_strategy_path = '' if no_mitogen else self.get_mitogen_strategy_plugins_path()
+
+            if mitogen_strategy_path:
+                self.io().debug('Using Mitogen strategy from %s' % mitogen_strategy_path)
+                command += 'export ANSIBLE_STRATEGY_PLUGINS=%s; export ANSIBLE_STRATEGY=mitogen_linear; ' % \
+                           mitogen_strategy_path
+
             command += 'ansible-playbook ./%s -i %s %s' % (
                 playbook_name,
                 inventory_name,
@@ -126,16 +149,63 @@ Example usage:
         self.io().info('Spawning Ansible, you may be asked for vault password to decrypt .env-prod')
         return self.sh(command)
 
+    @staticmethod
+    def get_mitogen_strategy_plugins_path() -> str:
+        """Returns path to Mitogen strategy plugins, when optional "mitogen" package is installed
+
+        Mitogen keeps Python interpreters on remote hosts between tasks, which speeds up Ansible significantly
+        """
+
+        spec = importlib.util.find_spec('ansible_mitogen')
+
+        if spec is None or not spec.submodule_search_locations:
+            return ''
+
+        return list(spec.submodule_search_locations)[0] + '/plugins/strategy'
+
     def spawn_ssh_agent(self) -> Tuple[str, int]:
-        out = subprocess.check_output('eval $(ssh-agent -s);echo "|${SSH_AUTH_SOCK}|${SSH_AGENT_PID}";', shell=True).decode('utf-8')
-        parts = out.split('|')
-        sock = parts[1]
-        pid = int(parts[2].strip())
+        out = subprocess.check_output(['ssh-agent', '-s']).decode('utf-8')
+        sock = re.search('SSH_AUTH_SOCK=([^;]+);', out).group(1)
+        pid = int(re.search('SSH_AGENT_PID=([0-9]+);', out).group(1))
 
         self.io().debug('Spawned ssh-agent - sock=%s, pid=%i' % (sock, pid))
 
         return sock, pid
 
+    def add_ssh_key(self, sock: str, pid: int, private_key_path: str):
+        """Adds a private key to the ssh-agent. ssh-add returns after the key is loaded, so no waiting is needed
+
+        ssh-agent binds its socket before printing it, so the agent is normally ready - only when ssh-add cannot
+        connect (exit code 2), then the agent is awaited and the key is added again
+        """
+
+        env = dict(os.environ)
+        env['SSH_AUTH_SOCK'] = sock
+        env['SSH_AGENT_PID'] = str(pid)
+        cmd = ['ssh-add', os.path.expanduser(private_key_path)]
+        exit_code = subprocess.call(cmd, env=env)
+
+        if exit_code == 2 and self.wait_for_ssh_agent(env):
+            exit_code = subprocess.call(cmd, env=env)
+
+        if exit_code != 0:
+            self.io().warn('Cannot add private key "%s" to the ssh-agent' % private_key_path)
+
+    def wait_for_ssh_agent(self, env: dict, attempts: int = 50, interval: float = 0.1) -> bool:
+        """Waits until ssh-agent accepts connections
+
+        "ssh-add -l" exits with 0 or 1 when connected to the agent (keys listed or no keys), 2 when it cannot connect
+        """
+
+        for _ in range(0, attempts):
+            if subprocess.call(['ssh-add', '-l'], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) != 2:
+                return True
+
+            time.sleep(interval)
+
+        self.io().warn('ssh-agent at "%s" is not responding' % env['SSH_AUTH_SOCK'])
+        return False
+
     def kill_ssh_agent(self, pid: int):
         self.io().debug('Clean up - killing ssh-agent at PID=%i' % pid)
         subprocess.check_call(['kill', str(pid)])
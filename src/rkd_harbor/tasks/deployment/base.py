@@ -1,9 +1,23 @@
 import os
+import json
+import glob
+import hashlib
+import shutil
 import subprocess
 from abc import ABC
+from typing import Iterator
+from typing import Optional
+from typing import Tuple
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from jinja2 import __version__ as jinja_version
 from jinja2 import Environment
 from jinja2 import FileSystemLoader
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import ModuleLoader
+from jinja2 import ChoiceLoader
 from jinja2 import StrictUndefined
+from jinja2 import meta
 from jinja2.exceptions import UndefinedError
 from argparse import ArgumentParser
 from rkd.api.contract import ExecutionContext
@@ -15,10 +29,15 @@ from ...exception import MissingDeploymentConfigurationError
 
 HARBOR_ROOT = os.path.dirname(os.path.realpath(__file__)) + '/../../deployment/files'
 
+# caches and temporary files written into .rkd/deployment, which is usually committed to the repository
+IGNORED_DEPLOYMENT_FILES = ['/.jinja_cache/', '/.jinja_compiled-*.zip', '/.synced.fingerprint', '*.tmp']
+
 
 class BaseDeploymentTask(HarborBaseTask, ABC):
     ansible_dir: str = '.rkd/deployment'
     _config: dict
+    _cached_variables: Optional[dict] = None
+    _jinja_env: Optional[Environment] = None
     vault_args: list = []
 
     def get_config(self) -> dict:
@@ -116,8 +135,37 @@ class BaseDeploymentTask(HarborBaseTask, ABC):
     def _write_synced_version(self, abs_ansible_dir: str):
         """Writes information about, in which Harbor version the files were synced last time"""
 
-        with open(abs_ansible_dir + '/.synced', 'wb') as f:
-            f.write(self.get_harbor_version().encode('utf-8'))
+        self._write_file_atomically(abs_ansible_dir + '/.synced', self.get_harbor_version().encode('utf-8'))
+
+    @staticmethod
+    def _write_file_atomically(path: str, content: bytes):
+        """Writes into a temporary file first, then replaces the target - an interrupted write never leaves
+        a truncated file"""
+
+        with open(path + '.tmp', 'wb') as f:
+            f.write(content)
+
+        os.replace(path + '.tmp', path)
+
+    def _update_gitignore(self, abs_ansible_dir: str):
+        """Adds caches and temporary files to .gitignore inside .rkd/deployment, keeps entries added by the user"""
+
+        path = abs_ansible_dir + '/.gitignore'
+        content = ''
+
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                content = f.read().decode('utf-8')
+
+        missing = [entry for entry in IGNORED_DEPLOYMENT_FILES if entry not in content.splitlines()]
+
+        if not missing:
+            return
+
+        if content and not content.endswith('\n'):
+            content += '\n'
+
+        self._write_file_atomically(path, (content + '\n'.join(missing) + '\n').encode('utf-8'))
 
     def role_is_installed_and_configured(self) -> bool:
         return os.path.isfile(self.ansible_dir + '/.synced')
@@ -154,6 +202,7 @@ class BaseDeploymentTask(HarborBaseTask, ABC):
 
         self.io().info('Checking role installation...')
         self._silent_mkdir(abs_ansible_dir)
+        self._update_gitignore(abs_ansible_dir)
         self._verify_synced_version(abs_ansible_dir)
 
         # optionally ask user and set facts such as passwords, key paths, sudo passwords
@@ -163,24 +212,116 @@ class BaseDeploymentTask(HarborBaseTask, ABC):
         self._ask_and_set_var(ctx, '--ask-ssh-key-path', 'SSH private key path', 'private_key', secret=False)
         self._ask_and_set_var(ctx, '--ask-sudo-pass', 'Sudo password for remote machines', 'sudo_pass', secret=True)
 
-        if not self._synchronize_structure_from_template(abs_ansible_dir, only_jinja_templates=True):
-            self.io().error_msg('Cannot synchronize templates')
-            return False
-
         if should_update:
             self.io().info('Role will be updated')
 
+            # templates are rendered together with the whole structure
             if not self._synchronize_structure_from_template(abs_ansible_dir):
                 self.io().error_msg('Cannot synchronize structure')
                 return False
 
+            self.io().debug('Precompiling templates...')
+            self._precompile_templates()
+
             self.io().debug('Downloading fresh role...')
             self.download_roles()
 
             self._write_synced_version(abs_ansible_dir)
 
+        elif self._templates_are_up_to_date(abs_ansible_dir):
+            self.io().debug('Templates are up-to-date, skipping rendering')
+            return True
+
+        elif not self._synchronize_structure_from_template(abs_ansible_dir, only_jinja_templates=True):
+            self.io().error_msg('Cannot synchronize templates')
+            return False
+
+        self._write_synced_fingerprint(abs_ansible_dir)
+
         return True
 
+    def _templates_are_up_to_date(self, abs_ansible_dir: str) -> bool:
+        """Checks if rendered templates exist and were rendered from same templates and variables"""
+
+        synced = self._read_synced_fingerprint(abs_ansible_dir)
+
+        if not synced['fingerprint']:
+            return False
+
+        dest_prefix = abs_ansible_dir + '/'
+
+        for abs_src_path, relative_path, is_dir in self._scan_template_tree(HARBOR_ROOT):
+            if relative_path.endswith('.j2') and not os.path.isfile(dest_prefix + relative_path[:-3]):
+                return False
+
+        return synced['fingerprint'] == self._get_templates_fingerprint(synced['variables'])
+
+    def _get_templates_fingerprint(self, variable_names: list) -> str:
+        """Calculates a checksum of everything the rendered templates depend on: Harbor version,
+        contents of the templates and values of variables used in templates"""
+
+        variables = self._prepare_variables()
+        used_variables = {name: variables.get(name) for name in variable_names}
+
+        return hashlib.sha256(
+            json.dumps([self.get_harbor_version(), self._get_templates_checksum(), used_variables],
+                       sort_keys=True, default=str)
+            .encode('utf-8')
+        ).hexdigest()
+
+    @staticmethod
+    def _get_templates_checksum() -> str:
+        """Checksum of JINJA2 templates contents. Modification times are not reliable - installers may preserve
+        original timestamps, so a different Harbor version could have older templates"""
+
+        checksum = hashlib.sha256()
+        templates = sorted(
+            (relative_path, abs_src_path)
+            for abs_src_path, relative_path, is_dir in BaseDeploymentTask._scan_template_tree(HARBOR_ROOT)
+            if relative_path.endswith('.j2')
+        )
+
+        for relative_path, abs_src_path in templates:
+            with open(abs_src_path, 'rb') as f:
+                checksum.update(relative_path.encode('utf-8') + b'\0' + f.read() + b'\0')
+
+        return checksum.hexdigest()
+
+    @staticmethod
+    def _get_templates_variable_names() -> list:
+        """Lists variables used in templates. Requires parsing, so it is done only when templates are rendered"""
+
+        names = set()
+
+        for abs_src_path, relative_path, is_dir in BaseDeploymentTask._scan_template_tree(HARBOR_ROOT):
+            if not relative_path.endswith('.j2'):
+                continue
+
+            with open(abs_src_path, 'rb') as f:
+                names.update(meta.find_undeclared_variables(Environment().parse(f.read().decode('utf-8'))))
+
+        return sorted(names)
+
+    @staticmethod
+    def _read_synced_fingerprint(abs_ansible_dir: str) -> dict:
+        try:
+            with open(abs_ansible_dir + '/.synced.fingerprint', 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+
+        except (FileNotFoundError, ValueError):
+            return {'fingerprint': '', 'variables': []}
+
+    def _write_synced_fingerprint(self, abs_ansible_dir: str):
+        """Stores a fingerprint of rendered templates together with names of variables it was calculated from,
+        so the next run can check if the templates are up-to-date without parsing them"""
+
+        variable_names = self._get_templates_variable_names()
+
+        self._write_file_atomically(abs_ansible_dir + '/.synced.fingerprint', json.dumps({
+            'fingerprint': self._get_templates_fingerprint(variable_names),
+            'variables': variable_names
+        }).encode('utf-8'))
+
     def download_roles(self):
         self.sh(' '.join([
             'ansible-galaxy',
@@ -195,69 +336,206 @@ class BaseDeploymentTask(HarborBaseTask, ABC):
         self.io().debug(
             'Synchronizing structure from template (only_jinja_templates=' + str(only_jinja_templates) + ')')
 
-        # synchronize directory structure
-        for root, subdirs, files in os.walk(HARBOR_ROOT):
-            relative_root = root[len(HARBOR_ROOT) + 1:]
+        variables = self._prepare_variables()
+        dest_prefix = abs_ansible_dir + '/'
+        directories = {abs_ansible_dir}
 
-            self._silent_mkdir(abs_ansible_dir + '/' + relative_root)
+        # environment is shared by the worker threads, so it is prepared before any work is submitted
+        jinja_env = self._get_jinja_env()
+        files_to_copy = []
 
-            for file in files:
-                if only_jinja_templates and not file.endswith('.j2'):
-                    continue
+        # collect directory structure
+        for abs_src_path, relative_path, is_dir in self._scan_template_tree(HARBOR_ROOT):
+            abs_dest_path = dest_prefix + relative_path
+
+            if is_dir:
+                directories.add(abs_dest_path)
+                continue
+
+            if only_jinja_templates and not relative_path.endswith('.j2'):
+                continue
 
-                abs_src_file_path = root + '/' + file
-                abs_dest_file_path = abs_ansible_dir + '/' + relative_root + '/' + file
+            files_to_copy.append((abs_src_path, relative_path, abs_dest_path))
 
-                if not self._copy_file(abs_src_file_path, abs_dest_file_path):
-                    self.io().error('Cannot process file %s' % abs_dest_file_path)
-                    return False
+        # whole directory tree is created up-front, parents first, so the files can be written in any order
+        for directory in sorted(directories, key=lambda path: path.count('/')):
+            os.makedirs(directory, exist_ok=True)
+
+        # files are independent of each other, so those can be copied and rendered in parallel
+        with ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4)) as executor:
+            futures = {
+                executor.submit(
+                    self._copy_file, abs_src_path, relative_path, abs_dest_path, variables, jinja_env
+                ): abs_dest_path
+                for abs_src_path, relative_path, abs_dest_path in files_to_copy
+            }
+
+            try:
+                for future in as_completed(futures):
+                    if not future.result():
+                        self.io().error('Cannot process file %s' % futures[future])
+                        return False
+            finally:
+                for future in futures:
+                    future.cancel()
 
         return True
 
-    def _copy_file(self, abs_src_file_path: str, abs_dest_file_path: str):
-        """Copies a file from template directory - supports jinja2 files rendering on-the-fly"""
+    @staticmethod
+    def _scan_template_tree(root: str) -> Iterator[Tuple[str, str, bool]]:
+        """Walks recursively through a directory, yields (absolute path, relative path, is directory) per entry
+
+        Parent directories are always yielded before their contents. os.scandir() returns the entry type together
+        with the directory listing, so no additional stat() call is needed per entry
+        """
+
+        # (absolute directory path, relative path prefix of its entries) - prefix is built once per directory
+        pending_dirs = [(root, '')]
+
+        while pending_dirs:
+            abs_dir, relative_prefix = pending_dirs.pop()
+
+            with os.scandir(abs_dir) as entries:
+                for entry in entries:
+                    relative_path = relative_prefix + entry.name
+                    is_dir = entry.is_dir()
+
+                    # symbolic links to directories are not descended into, same as os.walk() does by default
+                    if entry.is_dir(follow_symlinks=False):
+                        pending_dirs.append((entry.path, relative_path + '/'))
+
+                    yield entry.path, relative_path, is_dir
+
+    def _copy_file(self, abs_src_file_path: str, relative_path: str, abs_dest_file_path: str, variables: dict,
+                   jinja_env: Environment):
+        """Copies a file from template directory - supports jinja2 files rendering on-the-fly
+
+        JINJA2 templates are loaded by their path relative to the template directory, so the environment
+        can serve them from its cache. Rendered output is streamed into a temporary file, which replaces
+        the target only when rendering succeeded
+        """
 
         if abs_dest_file_path.endswith('.j2'):
             abs_dest_file_path = abs_dest_file_path[:-3]
-
-            with open(abs_src_file_path, 'rb') as f:
-                tpl = Environment(loader=FileSystemLoader(['./', './rkd/deployment']), undefined=StrictUndefined)\
-                        .from_string(f.read().decode('utf-8'))
+            tmp_path = abs_dest_file_path + '.tmp'
 
             try:
-                variables = self._prepare_variables()
+                tpl = jinja_env.get_template(relative_path)
+                tpl.stream(**variables).dump(tmp_path, encoding='utf-8')
+
+                # rendered files may contain credentials, permissions adjusted by the user are kept
+                if os.path.isfile(abs_dest_file_path):
+                    shutil.copymode(abs_dest_file_path, tmp_path)
 
-                with open(abs_dest_file_path, 'wb') as f:
-                    f.write(tpl.render(**variables).encode('utf-8'))
+                os.replace(tmp_path, abs_dest_file_path)
 
             except UndefinedError as e:
                 self.io().error(str(e) + " - required in " + abs_src_file_path + ", please define it in deployment.yml")
                 return False
 
+            finally:
+                if os.path.isfile(tmp_path):
+                    os.unlink(tmp_path)
+
             return True
 
-        subprocess.check_call(['cp', '-p', abs_src_file_path, abs_dest_file_path])
+        shutil.copy2(abs_src_file_path, abs_dest_file_path)
         self.io().debug('Created ' + abs_dest_file_path)
         return True
 
+    def _get_jinja_env(self) -> Environment:
+        """Lazily creates a JINJA2 environment shared between deployment tasks
+
+        Parsed templates are kept in memory by the environment, compiled templates are additionally stored
+        in .rkd/deployment/.jinja_cache, so the templates are not compiled again on next runs.
+
+        When templates were precompiled during files synchronization, then those are loaded first.
+        """
+
+        cache_dir = os.path.realpath(self.ansible_dir + '/.jinja_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        if BaseDeploymentTask._jinja_env is None or BaseDeploymentTask._jinja_env.bytecode_cache.directory != cache_dir:
+            loader = FileSystemLoader([HARBOR_ROOT, './', './rkd/deployment'])
+            compiled_path = self._get_compiled_templates_path()
+
+            if self._compiled_templates_are_up_to_date(compiled_path):
+                self.io().debug('Using precompiled templates from ' + compiled_path)
+                loader = ChoiceLoader([ModuleLoader(compiled_path), loader])
+
+            BaseDeploymentTask._jinja_env = Environment(
+                loader=loader,
+                undefined=StrictUndefined,
+                bytecode_cache=FileSystemBytecodeCache(cache_dir)
+            )
+
+        return BaseDeploymentTask._jinja_env
+
+    def _get_compiled_templates_path(self) -> str:
+        """Compiled templates are bound to the JINJA2 version that compiled them and to contents of the templates"""
+
+        return os.path.realpath(
+            self.ansible_dir + '/.jinja_compiled-' + jinja_version + '-' + self._get_templates_checksum()[:16] + '.zip'
+        )
+
+    @staticmethod
+    def _compiled_templates_are_up_to_date(compiled_path: str) -> bool:
+        """Checks if precompiled templates archive exists - its name identifies the templates it was compiled from"""
+
+        return os.path.isfile(compiled_path)
+
+    def _precompile_templates(self):
+        """Compiles JINJA2 templates ahead-of-time into a ZIP archive, next runs will skip parsing and compilation"""
+
+        compiled_path = self._get_compiled_templates_path()
+
+        Environment(loader=FileSystemLoader(HARBOR_ROOT), undefined=StrictUndefined).compile_templates(
+            target=compiled_path,
+            zip='deflated',
+            filter_func=lambda name: name.endswith('.j2'),
+            ignore_errors=False
+        )
+
+        # archives compiled from other templates or by other JINJA2 version will not be used anymore
+        for previous_path in glob.glob(os.path.realpath(self.ansible_dir) + '/.jinja_compiled-*.zip'):
+            if previous_path != compiled_path:
+                os.unlink(previous_path)
+
+        # next usage will pick up the fresh archive
+        BaseDeploymentTask._jinja_env = None
+
     def _prepare_variables(self):
-        """Glues together variables from environment and from deployment.yaml for exposing in JINJA2 templates"""
+        """Glues together variables from environment and from deployment.yaml for exposing in JINJA2 templates
+
+        The result is cached for the lifetime of the task, as deployment.yml is also loaded only once
+        """
+
+        if self._cached_variables is not None:
+            return self._cached_variables
+
+        config = self.get_config()
 
         variables = {}
         variables.update(os.environ)
-        variables.update(self.get_config())
+        variables.update(config)
 
         if 'git_url' not in variables:
-            variables['git_url'] = subprocess\
-                .check_output(['git', 'config', '--get', 'remote.origin.url']).decode('utf-8')\
-                .replace('\n', '')\
-                .strip()
+            variables['git_url'] = self._get_git_remote_url()
 
         if 'git_secret_url' not in variables:
             variables['git_secret_url'] = variables['git_url'].replace('\n', '')
 
+        self._cached_variables = variables
+
         return variables
 
+    @staticmethod
+    def _get_git_remote_url() -> str:
+        """Asks git for URL of the "origin" remote, git applies its own syntax rules and included configuration"""
+
+        return subprocess.run(['git', 'config', '--get', 'remote.origin.url'], stdout=subprocess.PIPE,
+                              universal_newlines=True, check=True).stdout.strip()
+
     def _preserve_vault_parameters_for_usage_in_inner_tasks(self, ctx: ExecutionContext):
         """Preserve original parameters related to Vault, so those parameters can be propagated to inner tasks"""
 
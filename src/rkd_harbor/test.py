@@ -1,13 +1,24 @@
 import os
+import shutil
 import subprocess
+import tempfile
 import time
 import yaml
 from dotenv import dotenv_values
 from typing import Dict
+from typing import Optional
+from typing import TYPE_CHECKING
+from io import StringIO
 from copy import deepcopy
 from argparse import ArgumentParser
 from rkd.api.contract import ExecutionContext
+from rkd.api.contract import TaskInterface
+from rkd.api.inputoutput import IO
 from rkd.api.inputoutput import BufferedSystemIO
+from rkd.api.temp import TempManager
+from rkd.context import ApplicationContext
+from rkd.execution.executor import OneByOneTaskExecutor
+from rkd.execution.results import ProgressObserver
 from rkd.api.syntax import TaskDeclaration
 from rkd.api.testing import FunctionalTestingCase
 from .tasks.base import HarborBaseTask
@@ -15,6 +26,9 @@ from .service import ServiceDeclaration
 from .driver import ComposeDriver
 from .cached_loader import CachedLoader
 
+if TYPE_CHECKING:
+    import docker
+
 HARBOR_MODULE_PATH = os.path.dirname(os.path.realpath(__file__))
 ENV_SIMPLE_PATH = os.path.dirname(os.path.realpath(__file__)) + '/../../test/testdata/env_simple'
 CURRENT_TEST_ENV_PATH = os.path.dirname(os.path.realpath(__file__)) + '/../../test/testdata/current_test_env'
@@ -41,6 +55,36 @@ class TestTask(HarborBaseTask):
 
 
 class BaseHarborTestClass(FunctionalTestingCase):
+    """Base class for functional tests of Harbor projects
+
+    Tests are talking to Docker through "docker" package, install it with: pip install rkd-harbor[testing]
+    """
+
+    _structure_snapshot_path: str = ''
+    _env_values: dict = {}
+    _docker_client: Optional['docker.DockerClient'] = None
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        super().setUpClass()
+
+        # build the project structure once per class, then each test gets a fresh copy of it
+        os.chdir(HARBOR_MODULE_PATH)
+        cls.build_structure()
+        cls._structure_snapshot_path = tempfile.mkdtemp() + '/structure'
+        shutil.copytree(CURRENT_TEST_ENV_PATH, cls._structure_snapshot_path, symlinks=True)
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        shutil.rmtree(os.path.dirname(cls._structure_snapshot_path), ignore_errors=True)
+        cls._structure_snapshot_path = ''
+
+        if cls._docker_client is not None:
+            cls._docker_client.close()
+            cls._docker_client = None
+
+        super().tearDownClass()
+
     def setUp(self) -> None:
         super().setUp()
 
@@ -58,6 +102,13 @@ class BaseHarborTestClass(FunctionalTestingCase):
         self.setup_environment()
         self.remove_all_containers()
 
+        # scaffolding for executing tasks is reused between calls within a test, only the buffers are cleared
+        self._shared_ctx = ApplicationContext([], [], '')
+        self._shared_ctx.io = BufferedSystemIO()
+        self._shared_executor = OneByOneTaskExecutor(self._shared_ctx, ProgressObserver(self._shared_ctx.io))
+        self._shared_capture_io = IO()
+        self._shared_stream = StringIO()
+
     @classmethod
     def mock_compose(cls, content: dict):
         content['version'] = '3.4'
@@ -65,19 +116,31 @@ class BaseHarborTestClass(FunctionalTestingCase):
         with open(CURRENT_TEST_ENV_PATH + '/apps/conf/mocked.yaml', 'wb') as f:
             f.write(yaml.dump(content).encode('utf-8'))
 
+        CachedLoader.invalidate('compose', 'services')
+
     @classmethod
     def recreate_structure(cls):
-        """Within each class recreate the project structure, as it could be changed by tests itself"""
+        """Within each test recreate the project structure, as it could be changed by tests itself"""
+
+        if not cls._structure_snapshot_path:
+            cls.build_structure()
+            return
+
+        shutil.rmtree(CURRENT_TEST_ENV_PATH, ignore_errors=True)
+        shutil.copytree(cls._structure_snapshot_path, CURRENT_TEST_ENV_PATH, symlinks=True)
+
+    @classmethod
+    def build_structure(cls):
+        """Builds the test project structure from env_simple and from the base Harbor project structure"""
 
-        subprocess.check_call(['rm', '-rf', CURRENT_TEST_ENV_PATH])
-        subprocess.check_call(['cp', '-pr', ENV_SIMPLE_PATH, CURRENT_TEST_ENV_PATH])
+        shutil.rmtree(CURRENT_TEST_ENV_PATH, ignore_errors=True)
+        shutil.copytree(ENV_SIMPLE_PATH, CURRENT_TEST_ENV_PATH, symlinks=True)
 
         # copy from base structure - as we test eg. things like default configurations, NGINX template
         for directory in ['containers', 'data', 'hooks.d', 'apps/www-data']:
-            subprocess.check_call('rm -rf %s/%s' % (ENV_SIMPLE_PATH, directory), shell=True)
-            subprocess.check_call('cp -pr %s/project/%s %s/%s' % (
-                HARBOR_MODULE_PATH, directory, CURRENT_TEST_ENV_PATH, directory
-            ), shell=True)
+            shutil.rmtree(CURRENT_TEST_ENV_PATH + '/' + directory, ignore_errors=True)
+            shutil.copytree(HARBOR_MODULE_PATH + '/project/' + directory, CURRENT_TEST_ENV_PATH + '/' + directory,
+                            symlinks=True)
 
         cls.mock_compose({'services': {}})
 
@@ -85,32 +148,95 @@ class BaseHarborTestClass(FunctionalTestingCase):
     def get_test_env_subdirectory(cls, subdir_name: str):
         directory = CURRENT_TEST_ENV_PATH + '/' + subdir_name
 
-        if not os.path.isdir(directory):
-            subprocess.check_call(['mkdir', '-p', directory])
+        os.makedirs(directory, exist_ok=True)
 
         return os.path.realpath(directory)
 
+    @classmethod
+    def docker_client(cls) -> 'docker.DockerClient':
+        """Docker API connection shared by all tests in a class, instead of spawning docker CLI for each check
+
+        "docker" package is required only by tests ("testing" extra), so it is not imported together with the module
+        """
+
+        if cls._docker_client is None:
+            import docker
+            cls._docker_client = docker.from_env()
+
+        return cls._docker_client
+
     @classmethod
     def remove_all_containers(cls):
-        try:
-            subprocess.check_output("docker rm -f -v $(docker ps -a --format '{{ .Names }}' | grep " + TEST_PROJECT_NAME + ")",
-                                    shell=True, stderr=subprocess.STDOUT)
+        from docker.errors import NotFound
 
-        except subprocess.CalledProcessError as e:
-            # no containers found - it's OK
-            if "requires at least 1 argument" in str(e.output):
-                return
+        # sparse listing does not inspect each container, the ID is enough to remove it
+        for container in cls.docker_client().containers.list(all=True, sparse=True,
+                                                             filters={'name': TEST_PROJECT_NAME}):
+            try:
+                container.remove(force=True, v=True)
 
-            raise e
+            # already removed in meantime - it's OK
+            except NotFound:
+                pass
 
     @classmethod
     def setup_environment(cls):
-        os.environ.update(dotenv_values(CURRENT_TEST_ENV_PATH + '/.env'))
+        if not cls._env_values:
+            cls._env_values = dotenv_values(CURRENT_TEST_ENV_PATH + '/.env')
+
+        os.environ.update(cls._env_values)
         os.environ['APPS_PATH'] = CURRENT_TEST_ENV_PATH + '/apps'
         os.environ['RKD_PATH'] = cls.get_test_env_subdirectory('') + ':' + HARBOR_MODULE_PATH + '/internal'
 
         os.chdir(CURRENT_TEST_ENV_PATH)
 
+    def execute_mocked_task_and_get_output(self, task: TaskInterface, args=None, env=None) -> str:
+        """Runs a single task and captures its output, reusing IO and context prepared in setUp()
+
+        Replaces rkd's FunctionalTestingCase.execute_mocked_task_and_get_output() instead of calling super():
+        the upstream helper builds its own context and IO, so those cannot be shared, and in rkd 2.4 it creates
+        OneByOneTaskExecutor without a required progress observer, so it fails before running the task
+        """
+
+        if args is None:
+            args = {}
+
+        if env is None:
+            env = {}
+
+        ctx = self._shared_ctx
+        ctx.io.clear_buffer()
+        self._shared_stream.seek(0)
+        self._shared_stream.truncate(0)
+
+        task.internal_inject_dependencies(
+            io=ctx.io,
+            ctx=ctx,
+            executor=self._shared_executor,
+            temp_manager=TempManager()
+        )
+
+        merged_env = deepcopy(os.environ)
+        merged_env.update(env)
+
+        defined_args = {arg: {'default': ''} for arg in args.keys()}
+
+        with self._shared_capture_io.capture_descriptors(enable_standard_out=True, stream=self._shared_stream):
+            try:
+                # noinspection PyTypeChecker
+                result = task.execute(ExecutionContext(
+                    TaskDeclaration(task),
+                    args=args,
+                    env=merged_env,
+                    defined_args=defined_args
+                ))
+            except Exception:
+                self._restore_standard_out()
+                print(ctx.io.get_value() + "\n" + self._shared_stream.getvalue())
+                raise
+
+        return ctx.io.get_value() + "\n" + self._shared_stream.getvalue() + "\nTASK_EXIT_RESULT=" + str(result)
+
     def _get_prepared_compose_driver(self, args: dict = {}, env: dict = {}) -> ComposeDriver:
         merged_env = deepcopy(os.environ)
         merged_env.update(env)
@@ -142,32 +268,32 @@ class BaseHarborTestClass(FunctionalTestingCase):
         return drv
 
     def get_containers_state(self, driver: ComposeDriver) -> Dict[str, bool]:
-        running_rows = driver.scope.sh('docker ps -a --format "{{ .Names }}|{{ .Status }}"', capture=True).split("\n")
-        containers = {}
+        """Lists project containers with information if those are up. Docker filters out containers of other projects"""
 
-        for container_row in running_rows:
-            try:
-                name, status = container_row.split('|')
-            except ValueError:
-                continue
+        containers = {}
 
-            if name.startswith(driver.project_name + '_'):
-                containers[name] = 'Up' in status
+        # sparse listing does not inspect each container - state is already a part of the list, name is under "Names"
+        for container in self.docker_client().containers.list(all=True, sparse=True,
+                                                              filters={'name': '^%s_' % driver.project_name}):
+            containers[container.attrs['Names'][0].lstrip('/')] = container.status in ['running', 'paused']
 
         return containers
 
     def get_locally_pulled_docker_images(self) -> list:
-        images = subprocess.check_output(['docker', 'images', '--format', '{{ .Repository }}:{{ .Tag }}'])\
-            .decode('utf-8')\
-            .split("\n")
+        images = []
+
+        for image in self.docker_client().images.list():
+            images += image.tags
 
         return images
 
     def exec_in_container(self, container_name: str, cmd: list) -> str:
-        return subprocess.check_output(
-            ['docker', 'exec', '-i', container_name] + cmd,
-            stderr=subprocess.STDOUT
-        ).decode('utf-8')
+        exit_code, output = self.docker_client().containers.get(container_name).exec_run(cmd)
+
+        if exit_code != 0:
+            raise subprocess.CalledProcessError(exit_code, cmd, output)
+
+        return output.decode('utf-8')
 
     def fetch_page_content(self, host: str):
         return self.exec_in_container(TEST_PROJECT_NAME + '_gateway_1', ['curl', '-s', '-vv', '--header',
@@ -267,10 +393,16 @@ nodes:
               -----END OPENSSH PRIVATE KEY-----
     ''')
 
-    def assertContainerIsNotRunning(self, service_name: str, driver: ComposeDriver):
+    def assertContainerIsNotRunning(self, service_name: str, driver: ComposeDriver,
+                                    containers: Dict[str, bool] = None):
+        """Pass already fetched containers state to avoid asking Docker again when asserting multiple services"""
+
         container_name_without_instance_num = driver.project_name + '_' + service_name + '_'
 
-        for name, state in self.get_containers_state(driver).items():
+        if containers is None:
+            containers = self.get_containers_state(driver)
+
+        for name, state in containers.items():
             if name.startswith(container_name_without_instance_num) and state is True:
                 self.fail('"%s" is running, but should not' % name)
 
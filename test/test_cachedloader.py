@@ -16,3 +16,12 @@ class CachedLoaderTest(BaseHarborTestClass):
         test = CachedLoader.cached('test', lambda: loader(test))
 
         self.assertEqual(test, 1)
+
+    def test_invalidate_forgets_only_selected_entries(self):
+        CachedLoader.cached('first', lambda: 'first-value')
+        CachedLoader.cached('second', lambda: 'second-value')
+
+        CachedLoader.invalidate('first', 'not-existing')
+
+        self.assertEqual('first-new-value', CachedLoader.cached('first', lambda: 'first-new-value'))
+        self.assertEqual('second-value', CachedLoader.cached('second', lambda: 'second-new-value'))
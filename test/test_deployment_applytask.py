@@ -1,4 +1,8 @@
+import os
 import subprocess
+from types import SimpleNamespace
+from unittest.mock import patch
+from rkd.api.inputoutput import BufferedSystemIO
 from rkd_harbor.test import BaseHarborTestClass
 from rkd_harbor.tasks.deployment.apply import DeploymentTask
 from rkd_harbor.tasks.deployment.syncfiles import UpdateFilesTask
@@ -16,6 +20,7 @@ class DeploymentTaskTest(BaseHarborTestClass):
                                       '--branch': 'master',
                                       '--profile': '',
                                       '--debug': False,
+                                      '--no-mitogen': False,
                                       '--vault-passwords': '',
                                       '--ask-vault-pass': False,
                                       '--ask-ssh-login': False,
@@ -60,6 +65,7 @@ class DeploymentTaskTest(BaseHarborTestClass):
                                 '--branch': 'master',
                                 '--profile': '',
                                 '--debug': False,
+                                '--no-mitogen': False,
                                 '--vault-passwords': '',
                                 '--ask-vault-pass': False,
                                 '--ask-ssh-login': False,
@@ -118,6 +124,7 @@ class DeploymentTaskTest(BaseHarborTestClass):
                                       '--branch': 'master',
                                       '--profile': '',
                                       '--debug': False,
+                                      '--no-mitogen': False,
                                       '--vault-passwords': passphrase_file_path,
                                       '--ask-vault-pass': False,
                                       '--ask-ssh-login': False,
@@ -131,3 +138,191 @@ class DeploymentTaskTest(BaseHarborTestClass):
         self.assertIn('.rkd/tmp-secret.txt', ansible_call[0][0])
         self.assertIn('TASK_EXIT_RESULT=True', out)
 
+    def test_functional_uses_mitogen_strategy_when_mitogen_is_installed(self):
+        """When "ansible_mitogen" package is importable, then Ansible is configured to use Mitogen strategy"""
+
+        self._prepare_synchronized_deployment()
+        ansible_call = []
+
+        deployment_task = DeploymentTask()
+        deployment_task.spawn_ansible = lambda *args, **kwargs: ansible_call.append(args)
+
+        with patch('importlib.util.find_spec',
+                   return_value=SimpleNamespace(submodule_search_locations=['/opt/ansible_mitogen'])):
+            self._apply(deployment_task)
+
+        self.assertIn('export ANSIBLE_STRATEGY_PLUGINS=/opt/ansible_mitogen/plugins/strategy;', ansible_call[0][0])
+        self.assertIn('export ANSIBLE_STRATEGY=mitogen_linear;', ansible_call[0][0])
+
+    def test_functional_mitogen_is_not_used_when_disabled_by_switch(self):
+        """--no-mitogen switch allows to deploy without Mitogen even if it is installed"""
+
+        self._prepare_synchronized_deployment()
+        ansible_call = []
+
+        deployment_task = DeploymentTask()
+        deployment_task.spawn_ansible = lambda *args, **kwargs: ansible_call.append(args)
+
+        with patch('importlib.util.find_spec',
+                   return_value=SimpleNamespace(submodule_search_locations=['/opt/ansible_mitogen'])):
+            self._apply(deployment_task, {'--no-mitogen': True})
+
+        self.assertIn('ansible-playbook', ansible_call[0][0])
+        self.assertNotIn('mitogen', ansible_call[0][0])
+
+    def test_functional_skips_rendering_templates_when_nothing_changed(self):
+        """Templates rendered by :deployment:files:update are not rendered again when neither templates,
+        nor deployment.yml changed"""
+
+        self._prepare_synchronized_deployment()
+        synchronizations = []
+
+        deployment_task = DeploymentTask()
+        deployment_task.spawn_ansible = lambda *args, **kwargs: None
+        deployment_task._synchronize_structure_from_template = lambda *args, **kwargs: synchronizations.append(args)
+
+        out = self._apply(deployment_task)
+
+        self.assertEqual([], synchronizations)
+        self.assertIn('TASK_EXIT_RESULT=True', out)
+
+    def test_functional_renders_templates_again_when_deployment_yml_changes(self):
+        """Change of a value used in templates causes rendering of templates again"""
+
+        self._prepare_synchronized_deployment()
+        deployment_yml_path = self.get_test_env_subdirectory('') + '/deployment.yml'
+        inventory_path = self.get_test_env_subdirectory('.rkd/deployment') + '/harbor.inventory.cfg'
+
+        with open(deployment_yml_path, 'r') as f:
+            content = f.read()
+
+        with open(deployment_yml_path, 'w') as f:
+            f.write(content.replace('host: 127.0.0.1', 'host: 10.0.0.5'))
+
+        deployment_task = DeploymentTask()
+        deployment_task.spawn_ansible = lambda *args, **kwargs: None
+        self._apply(deployment_task)
+
+        with open(inventory_path, 'r') as f:
+            inventory = f.read()
+
+        self.assertIn('10.0.0.5', inventory)
+        self.assertNotIn('127.0.0.1', inventory)
+
+    def test_functional_renders_templates_again_when_rendered_file_is_missing(self):
+        """Removal of a rendered file causes rendering of templates again"""
+
+        self._prepare_synchronized_deployment()
+        inventory_path = self.get_test_env_subdirectory('.rkd/deployment') + '/harbor.inventory.cfg'
+        os.unlink(inventory_path)
+
+        deployment_task = DeploymentTask()
+        deployment_task.spawn_ansible = lambda *args, **kwargs: None
+        self._apply(deployment_task)
+
+        self.assertTrue(os.path.isfile(inventory_path))
+
+    def test_functional_ansible_config_selected_by_user_is_not_overridden(self):
+        """ansible.cfg shipped with Harbor is used by default, ANSIBLE_CONFIG exported by the user has priority"""
+
+        self._prepare_synchronized_deployment()
+        ansible_calls = []
+
+        with self.subTest('Harbor configuration by default'):
+            deployment_task = DeploymentTask()
+            deployment_task.spawn_ansible = lambda *args, **kwargs: ansible_calls.append(args)
+
+            with self.environment({'ANSIBLE_CONFIG': ''}):
+                self._apply(deployment_task)
+
+            self.assertIn('export ANSIBLE_CONFIG=./ansible.cfg;', ansible_calls[0][0])
+
+        with self.subTest('Configuration selected by the user'):
+            deployment_task = DeploymentTask()
+            deployment_task.spawn_ansible = lambda *args, **kwargs: ansible_calls.append(args)
+
+            with self.environment({'ANSIBLE_CONFIG': '/etc/ansible/custom.cfg'}):
+                self._apply(deployment_task)
+
+            self.assertNotIn('ANSIBLE_CONFIG', ansible_calls[1][0])
+
+    def test_spawn_ssh_agent_parses_socket_and_pid(self):
+        """Socket path and PID are parsed from "ssh-agent -s" output"""
+
+        task = self.satisfy_task_dependencies(DeploymentTask(), BufferedSystemIO())
+        agent_output = b'SSH_AUTH_SOCK=/tmp/ssh-XXXXRmZ1Ag/agent.1520; export SSH_AUTH_SOCK;\n' + \
+                       b'SSH_AGENT_PID=1521; export SSH_AGENT_PID;\n' + \
+                       b'echo Agent pid 1521;\n'
+
+        with patch('subprocess.check_output', return_value=agent_output):
+            sock, pid = task.spawn_ssh_agent()
+
+        self.assertEqual('/tmp/ssh-XXXXRmZ1Ag/agent.1520', sock)
+        self.assertEqual(1521, pid)
+
+    def test_add_ssh_key_waits_for_agent_and_retries_when_agent_is_not_reachable(self):
+        """When ssh-add cannot connect to the agent (exit code 2), then agent is awaited and key is added again"""
+
+        task = self.satisfy_task_dependencies(DeploymentTask(), BufferedSystemIO())
+
+        # ssh-add ~/.ssh/id_rsa -> cannot connect, ssh-add -l -> connected, ssh-add ~/.ssh/id_rsa -> added
+        with patch('subprocess.call', side_effect=[2, 0, 0]) as call, patch('time.sleep'):
+            task.add_ssh_key('/tmp/agent.sock', 1521, '/tmp/id_rsa')
+
+        self.assertEqual(
+            [['ssh-add', '/tmp/id_rsa'], ['ssh-add', '-l'], ['ssh-add', '/tmp/id_rsa']],
+            [args[0] for args, kwargs in call.call_args_list]
+        )
+
+    def test_add_ssh_key_gives_up_when_agent_is_not_responding(self):
+        """Agent is awaited for a limited number of attempts, then a warning is logged"""
+
+        io = BufferedSystemIO()
+        task = self.satisfy_task_dependencies(DeploymentTask(), io)
+
+        with patch('subprocess.call', return_value=2) as call, patch('time.sleep') as sleep:
+            task.add_ssh_key('/tmp/agent.sock', 1521, '/tmp/id_rsa')
+
+        # one attempt to add a key, then polling 50 times (default number of attempts)
+        self.assertEqual(51, call.call_count)
+        self.assertEqual(50, sleep.call_count)
+        self.assertIn('ssh-agent at "/tmp/agent.sock" is not responding', io.get_value())
+        self.assertIn('Cannot add private key "/tmp/id_rsa" to the ssh-agent', io.get_value())
+
+    def _prepare_synchronized_deployment(self) -> str:
+        """Internal: Writes deployment.yml and synchronizes files structure, as :deployment:files:update does"""
+
+        self.prepare_valid_deployment_yml()
+        update_task = UpdateFilesTask()
+        update_task.download_roles = lambda *args, **kwargs: None
+
+        return self.execute_mocked_task_and_get_output(update_task, args={
+            '--ask-vault-pass': False,
+            '--vault-passwords': '',
+            '--ask-ssh-login': False,
+            '--ask-ssh-pass': False,
+            '--ask-ssh-key-path': False,
+            '--ask-sudo-pass': False
+        }, env={})
+
+    def _apply(self, deployment_task: DeploymentTask, args: dict = None) -> str:
+        """Internal: Runs :deployment:apply with default switches, optionally overridden by given args"""
+
+        default_args = {
+            '--playbook': 'harbor.playbook.yml',
+            '--inventory': 'harbor.inventory.yml',
+            '--git-key': '',
+            '--branch': 'master',
+            '--profile': '',
+            '--debug': False,
+            '--no-mitogen': False,
+            '--vault-passwords': '',
+            '--ask-vault-pass': False,
+            '--ask-ssh-login': False,
+            '--ask-ssh-pass': False,
+            '--ask-ssh-key-path': False,
+            '--ask-sudo-pass': False
+        }
+        default_args.update(args or {})
+
+        return self.execute_mocked_task_and_get_output(deployment_task, args=default_args, env={})
@@ -1,5 +1,14 @@
 import os
+import shutil
+import stat
+import subprocess
+import tempfile
+from jinja2 import DictLoader
+from jinja2 import Environment
+from jinja2 import StrictUndefined
+from rkd.api.inputoutput import BufferedSystemIO
 from rkd_harbor.test import BaseHarborTestClass
+from rkd_harbor.tasks.deployment.base import BaseDeploymentTask
 from rkd_harbor.tasks.deployment.syncfiles import UpdateFilesTask
 
 
@@ -41,3 +50,142 @@ class UpdateFilesTaskTest(BaseHarborTestClass):
             with open(self.get_test_env_subdirectory('.rkd/deployment') + '/harbor.inventory.cfg', 'r') as f:
                 # vagrant is a default value from file created by self.prepare_valid_deployment_yml()
                 self.assertIn('ansible_ssh_user=docker', f.read())
+
+    def test_functional_caches_are_added_to_gitignore(self):
+        """Caches written into .rkd/deployment are ignored by GIT, also in projects created before,
+        entries added by the user are kept"""
+
+        self.prepare_valid_deployment_yml()
+        gitignore_path = self.get_test_env_subdirectory('.rkd/deployment') + '/.gitignore'
+
+        with open(gitignore_path, 'w') as f:
+            f.write('/my-custom-file\n*.tmp')
+
+        task = UpdateFilesTask()
+        task.download_roles = lambda *args, **kwargs: None
+
+        self.execute_mocked_task_and_get_output(task, args={
+            '--ask-vault-pass': False,
+            '--vault-passwords': '',
+            '--ask-ssh-login': False,
+            '--ask-ssh-pass': False,
+            '--ask-ssh-key-path': False,
+            '--ask-sudo-pass': False
+        }, env={})
+
+        with open(gitignore_path, 'r') as f:
+            self.assertEqual(
+                ['/my-custom-file', '*.tmp', '/.jinja_cache/', '/.jinja_compiled-*.zip', '/.synced.fingerprint'],
+                f.read().splitlines()
+            )
+
+    def test_template_tree_scan_does_not_follow_symbolic_links_to_directories(self):
+        """Symbolic link pointing to a parent directory is listed as a directory, but not entered - no endless loop"""
+
+        tree_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tree_dir)
+
+        os.mkdir(tree_dir + '/roles')
+        os.symlink('..', tree_dir + '/roles/loop')
+
+        with open(tree_dir + '/roles/main.yml', 'w') as f:
+            f.write('---')
+
+        entries = sorted(
+            (relative_path, is_dir)
+            for abs_path, relative_path, is_dir in BaseDeploymentTask._scan_template_tree(tree_dir)
+        )
+
+        self.assertEqual([('roles', True), ('roles/loop', True), ('roles/main.yml', False)], entries)
+
+    def test_failed_rendering_keeps_previously_rendered_file(self):
+        """When a variable is missing, then the file rendered last time is left untouched, no temporary file is left"""
+
+        task = self.satisfy_task_dependencies(UpdateFilesTask(), BufferedSystemIO())
+        dest_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest_dir)
+
+        with open(dest_dir + '/inventory.cfg', 'w') as f:
+            f.write('previous')
+
+        result = task._copy_file('/templates/inventory.cfg.j2', 'inventory.cfg.j2', dest_dir + '/inventory.cfg.j2',
+                                 {}, self._create_jinja_env('{{ missing_variable }}'))
+
+        self.assertFalse(result)
+        self.assertEqual(['inventory.cfg'], os.listdir(dest_dir))
+
+        with open(dest_dir + '/inventory.cfg', 'r') as f:
+            self.assertEqual('previous', f.read())
+
+    def test_rendering_error_does_not_leave_temporary_file(self):
+        """Other errors than a missing variable are raised, but the temporary file is cleaned up"""
+
+        task = self.satisfy_task_dependencies(UpdateFilesTask(), BufferedSystemIO())
+        dest_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest_dir)
+
+        with self.assertRaises(TypeError):
+            task._copy_file('/templates/inventory.cfg.j2', 'inventory.cfg.j2', dest_dir + '/inventory.cfg.j2',
+                            {'number': 1}, self._create_jinja_env('{{ number + "text" }}'))
+
+        self.assertEqual([], os.listdir(dest_dir))
+
+    def test_rendering_keeps_permissions_of_previously_rendered_file(self):
+        """Rendered files may contain passwords - permissions restricted by the user are preserved"""
+
+        task = self.satisfy_task_dependencies(UpdateFilesTask(), BufferedSystemIO())
+        dest_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest_dir)
+
+        with open(dest_dir + '/inventory.cfg', 'w') as f:
+            f.write('previous')
+
+        os.chmod(dest_dir + '/inventory.cfg', 0o600)
+
+        result = task._copy_file('/templates/inventory.cfg.j2', 'inventory.cfg.j2', dest_dir + '/inventory.cfg.j2',
+                                 {'password': 'secret'}, self._create_jinja_env('ansible_ssh_pass={{ password }}'))
+
+        self.assertTrue(result)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(dest_dir + '/inventory.cfg').st_mode))
+
+        with open(dest_dir + '/inventory.cfg', 'r') as f:
+            self.assertEqual('ansible_ssh_pass=secret', f.read())
+
+    def test_git_url_is_read_from_config_with_mixed_indentation(self):
+        """Indented line after not indented "url" is a separate key, not a continuation of the URL"""
+
+        self._create_git_repository_with_config('''[core]
+\tbare = false
+[remote "origin"]
+url = git@github.com:riotkit-org/riotkit-harbor.git
+\tfetch = +refs/heads/*:refs/remotes/origin/*
+''')
+
+        self.assertEqual('git@github.com:riotkit-org/riotkit-harbor.git', UpdateFilesTask._get_git_remote_url())
+
+    def test_git_url_with_quotes_and_comment_is_parsed_by_git(self):
+        """Quoted values and comments in GIT configuration are resolved to a plain URL"""
+
+        self._create_git_repository_with_config('''[core]
+\tbare = false
+[remote "origin"]
+\turl = "git@github.com:riotkit-org/riotkit-harbor.git" ; comment
+''')
+
+        self.assertEqual('git@github.com:riotkit-org/riotkit-harbor.git', UpdateFilesTask._get_git_remote_url())
+
+    def _create_git_repository_with_config(self, config: str):
+        """Internal: Creates a GIT repository in a temporary directory, enters it and replaces .git/config"""
+
+        repository_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, repository_dir)
+
+        subprocess.check_call(['git', 'init', '-q', repository_dir])
+        os.chdir(repository_dir)
+
+        with open('.git/config', 'w') as f:
+            f.write(config)
+
+    @staticmethod
+    def _create_jinja_env(template: str) -> Environment:
+        return Environment(loader=DictLoader({'inventory.cfg.j2': template}), undefined=StrictUndefined)